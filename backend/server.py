@@ -1,16 +1,27 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, UploadFile, File, Depends, Header, Query
+from fastapi.responses import StreamingResponse, HTMLResponse, PlainTextResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import re
+import math
+import time
+import asyncio
+import unicodedata
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import List, Optional, Literal
+from collections import OrderedDict, defaultdict
 import uuid
-from datetime import datetime, timezone
+import json
+import hashlib
+from datetime import datetime, timezone, timedelta
 from io import BytesIO
+from html import escape
 from openpyxl import Workbook, load_workbook
 
 ROOT_DIR = Path(__file__).parent
@@ -44,6 +55,9 @@ logger = logging.getLogger(__name__)
 
 # ===================== MODELS =====================
 
+# Orders placed without an explicit group belong to this group
+DEFAULT_GROUP_ID = "default"
+
 class MenuItem(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -67,21 +81,37 @@ class OrderCreate(BaseModel):
     customer_name: str
     items: List[OrderItemCreate]
     remarks: Optional[str] = None
+    group_id: str = DEFAULT_GROUP_ID
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    group_id: str = DEFAULT_GROUP_ID
     customer_name: str
     items: List[OrderItem]
     total_price: float
     remarks: Optional[str] = None
     is_paid: bool = False
+    version: int = 0
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class OrderUpdate(BaseModel):
     items: Optional[List[OrderItemCreate]] = None
     is_paid: Optional[bool] = None
     remarks: Optional[str] = None
+    expected_version: Optional[int] = None
+
+class OrderItemPatch(BaseModel):
+    """Change a single order line, identified by menu_item_id and optionally its position"""
+    op: Literal["add", "increment", "decrement", "remove"]
+    menu_item_id: str
+    # Position in order.items; needed when the order has several lines for the same menu item
+    index: Optional[int] = Field(default=None, ge=0)
+    quantity: int = Field(default=1, gt=0)
+    # Only needed for "add" when the item is not yet in the order
+    name: Optional[str] = None
+    price: Optional[float] = None
+    expected_version: Optional[int] = None
 
 class ActivityLogEntry(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -94,7 +124,8 @@ class ActivityLogEntry(BaseModel):
     client_ip: Optional[str] = None
 
 class ActivityLogCreate(BaseModel):
-    action: str
+    # Server-side actions are logged by the endpoints themselves; clients may only record these
+    action: Literal["Admin login", "Admin logout"]
     details: str
     order_id: Optional[str] = None
     device_info: Optional[str] = None
@@ -108,6 +139,7 @@ class AppSettings(BaseModel):
     email_subject: str = "Bestelling P&TA"
     email_intro: str = "Hierbij de bestelling voor vandaag:"
     email_outro: str = "Graag zo snel mogelijk bezorgen. Alvast bedankt!"
+    version: int = 0
 
 class AppSettingsUpdate(BaseModel):
     payment_link: Optional[str] = None
@@ -120,6 +152,48 @@ class AppSettingsUpdate(BaseModel):
 class AdminVerify(BaseModel):
     pin: str
 
+class OrderGroupSettings(BaseModel):
+    """Per-group overrides of AppSettings; None falls back to the app-wide value"""
+    payment_link: Optional[str] = None
+    order_email: Optional[str] = None
+    email_subject: Optional[str] = None
+    email_intro: Optional[str] = None
+    email_outro: Optional[str] = None
+
+class OrderGroup(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    settings: OrderGroupSettings = Field(default_factory=OrderGroupSettings)
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+class OrderGroupCreate(BaseModel):
+    name: str
+    settings: Optional[OrderGroupSettings] = None
+
+class OrderGroupUpdate(BaseModel):
+    name: Optional[str] = None
+    settings: Optional[OrderGroupSettings] = None
+
+class OrderSummaryLine(BaseModel):
+    name: str
+    remarks: str
+    quantity: int
+    subtotal: float
+
+class OrderGroupSummary(BaseModel):
+    group_id: str
+    order_count: int
+    paid_count: int
+    grand_total: float
+    items: List[OrderSummaryLine]
+
+class OrderEmail(BaseModel):
+    order_email: str
+    subject: str
+    body_text: str
+    body_html: str
+
 # ===================== MENU DATA =====================
 
 MENU_DATA = [
@@ -292,15 +366,485 @@ MENU_DATA = [
     {"name": "Monster Energy Ultra Strawberry Dreams", "category": "DRANKEN", "price": 3.50},
 ]
 
-# ===================== ROUTES =====================
+# ===================== HELPERS =====================
 
-@api_router.get("/")
-async def root():
-    return {"message": "P&TA Snack Bestel App API"}
+async def get_versions() -> dict:
+    """Get the change counters for orders, groups and the menu"""
+    versions = await db.app_state.find_one({"id": "versions"}, {"_id": 0})
+    return versions or {}
+
+async def bump_version(*keys: str):
+    """Increment change counters so cached renderings are invalidated on every worker"""
+    await db.app_state.update_one({"id": "versions"}, {"$inc": {key: 1 for key in keys}}, upsert=True)
+
+def orders_version_key(group_id: str) -> str:
+    return f"orders.{group_id}"
+
+def group_version_key(group_id: str) -> str:
+    return f"groups.{group_id}"
+
+def format_price(price: float) -> str:
+    """Format a price as EUR with Dutch notation, e.g. € 1.234,50"""
+    formatted = f"{price:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"€ {formatted}"
+
+def aggregate_order_lines(orders: list) -> list:
+    """Group ordered items by name + order remarks, plain items first"""
+    lines = {}
+    for order in orders:
+        remarks = (order.get("remarks") or "").strip()
+        for item in order.get("items", []):
+            key = (item["name"], remarks)
+            if key not in lines:
+                lines[key] = {"name": item["name"], "remarks": remarks, "quantity": 0, "price": item["price"]}
+            lines[key]["quantity"] += item["quantity"]
+    return sorted(lines.values(), key=lambda x: (bool(x["remarks"]), x["name"].lower()))
+
+def render_email_text(lines: list, grand_total: float, settings: AppSettings) -> str:
+    totals_text = "\n".join(
+        f"{line['quantity']}x {line['name']}"
+        f"{' - ' + line['remarks'] if line['remarks'] else ''}"
+        f" - {format_price(line['quantity'] * line['price'])}"
+        for line in lines
+    )
+    return f"{settings.email_intro}\n\n{totals_text}\n\nTotaal: {format_price(grand_total)}\n\n{settings.email_outro}"
+
+def render_email_html(lines: list, grand_total: float, settings: AppSettings) -> str:
+    rows = "".join(
+        f"<tr><td>{line['quantity']}x</td><td>{escape(line['name'])}</td>"
+        f"<td>{escape(line['remarks'])}</td>"
+        f"<td style=\"text-align:right\">{format_price(line['quantity'] * line['price'])}</td></tr>"
+        for line in lines
+    )
+    return (
+        f"<p>{escape(settings.email_intro)}</p>"
+        f"<table>{rows}</table>"
+        f"<p><strong>Totaal: {format_price(grand_total)}</strong></p>"
+        f"<p>{escape(settings.email_outro)}</p>"
+    )
+
+def render_receipt_text(orders: list, lines: list, grand_total: float, settings: AppSettings) -> str:
+    parts = [settings.email_subject, ""]
+    for order in orders:
+        paid = "betaald" if order.get("is_paid") else "niet betaald"
+        parts.append(f"{order['customer_name']} ({paid}) - {format_price(order['total_price'])}")
+        for item in order.get("items", []):
+            parts.append(f"  {item['quantity']}x {item['name']} - {format_price(item['quantity'] * item['price'])}")
+        if order.get("remarks"):
+            parts.append(f"  Opmerking: {order['remarks']}")
+    parts += ["", "Totaaloverzicht"]
+    parts += [
+        f"{line['quantity']}x {line['name']}{' - ' + line['remarks'] if line['remarks'] else ''}"
+        f" - {format_price(line['quantity'] * line['price'])}"
+        for line in lines
+    ]
+    parts += ["", f"Totaal: {format_price(grand_total)}"]
+    return "\n".join(parts)
+
+def render_receipt_html(orders: list, lines: list, grand_total: float, settings: AppSettings) -> str:
+    order_blocks = []
+    for order in orders:
+        paid = "betaald" if order.get("is_paid") else "niet betaald"
+        items = "".join(
+            f"<tr><td>{item['quantity']}x</td><td>{escape(item['name'])}</td>"
+            f"<td class=\"price\">{format_price(item['quantity'] * item['price'])}</td></tr>"
+            for item in order.get("items", [])
+        )
+        remarks = f"<p class=\"remarks\">Opmerking: {escape(order['remarks'])}</p>" if order.get("remarks") else ""
+        order_blocks.append(
+            f"<section><h2>{escape(order['customer_name'])} <small>({paid})</small></h2>"
+            f"<table>{items}</table>{remarks}"
+            f"<p class=\"price\">{format_price(order['total_price'])}</p></section>"
+        )
+    return (
+        "<!DOCTYPE html><html lang=\"nl\"><head><meta charset=\"utf-8\">"
+        f"<title>{escape(settings.email_subject)}</title>"
+        "<style>body{font-family:sans-serif;max-width:640px;margin:auto;color:#000}"
+        "table{width:100%;border-collapse:collapse}td{padding:2px 4px}"
+        ".price{text-align:right}.remarks{font-style:italic}"
+        "section{border-bottom:1px dashed #999;page-break-inside:avoid}</style></head><body>"
+        f"<h1>{escape(settings.email_subject)}</h1>"
+        f"{''.join(order_blocks)}"
+        "<h2>Totaaloverzicht</h2>"
+        f"{render_email_html(lines, grand_total, settings)}"
+        "</body></html>"
+    )
+
+async def get_group(group_id: str) -> OrderGroup:
+    """Get an order group; the default group exists implicitly"""
+    group = await db.order_groups.find_one({"id": group_id}, {"_id": 0})
+    if group:
+        return OrderGroup(**group)
+    if group_id == DEFAULT_GROUP_ID:
+        return OrderGroup(id=DEFAULT_GROUP_ID, name="Standaard")
+    raise HTTPException(status_code=404, detail="Group not found")
+
+async def get_group_orders(group_id: str) -> list:
+    """Get the orders of one group, oldest first (served by the group_id/created_at index)"""
+    return await db.orders.find({"group_id": group_id}, {"_id": 0}).sort("created_at", 1).to_list(1000)
+
+def apply_group_settings(settings: AppSettings, group: OrderGroup) -> AppSettings:
+    """App-wide settings with the group's overrides applied"""
+    overrides = group.settings.model_dump(exclude_none=True)
+    return settings.model_copy(update=overrides) if overrides else settings
+
+# Rendered order output per group, keyed by (orders, settings, group) versions
+_rendered_orders_cache = {}
+
+async def get_rendered_orders(group_id: str) -> dict:
+    """Render the aggregated order of a group once per orders/settings version"""
+    # Key on the version of the settings actually rendered, not a shared counter that may
+    # be ahead of this worker's settings cache
+    settings = await get_cached_settings()
+    versions = await get_versions()
+    key = (
+        versions.get("orders", {}).get(group_id, 0),
+        settings.version,
+        versions.get("groups", {}).get(group_id, 0)
+    )
+    cached = _rendered_orders_cache.get(group_id)
+    if cached and cached["key"] == key:
+        return cached["value"]
+
+    group = await get_group(group_id)
+    orders = await get_group_orders(group_id)
+    settings = apply_group_settings(settings, group)
+    lines = aggregate_order_lines(orders)
+    grand_total = sum(order.get("total_price", 0) for order in orders)
+
+    rendered = {
+        "order_email": settings.order_email,
+        "subject": settings.email_subject,
+        "email_text": render_email_text(lines, grand_total, settings),
+        "email_html": render_email_html(lines, grand_total, settings),
+        "receipt_text": render_receipt_text(orders, lines, grand_total, settings),
+        "receipt_html": render_receipt_html(orders, lines, grand_total, settings),
+    }
+    _rendered_orders_cache[group_id] = {"key": key, "value": rendered}
+    return rendered
+
+# ===================== RATE LIMITING =====================
+
+# Number of proxies in front of the app that append to X-Forwarded-For (Render adds one)
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+
+def get_trusted_client_ip(request: Request) -> str:
+    """Client IP as seen by our own proxy; earlier X-Forwarded-For entries are client-controlled"""
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    if TRUSTED_PROXY_HOPS and len(hops) >= TRUSTED_PROXY_HOPS:
+        return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+class TokenBucketLimiter:
+    """In-process token bucket per client, refilled continuously"""
+    MAX_CLIENTS = 10000
+
+    def __init__(self, capacity: int, per_minute: int):
+        self.capacity = capacity
+        self.refill_rate = per_minute / 60.0
+        # Least recently used clients are evicted once MAX_CLIENTS is reached
+        self.buckets = OrderedDict()
+
+    def _refill(self, key: str) -> float:
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - last) * self.refill_rate)
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.MAX_CLIENTS:
+            self.buckets.popitem(last=False)
+        return tokens
+
+    def peek(self, key: str) -> float:
+        """Returns 0 if key has a token available, else seconds until it has one; takes nothing"""
+        tokens = self._refill(key)
+        return 0 if tokens >= 1 else (1 - tokens) / self.refill_rate
+
+    def consume(self, key: str):
+        """Take a token for key; call only after peek allowed it"""
+        tokens, last = self.buckets[key]
+        self.buckets[key] = (tokens - 1, last)
+
+# Per-route budgets as (burst capacity, requests per minute). Colleagues share the office
+# NAT address, so each device (X-Device-Id) gets its own budget, and the IP as a whole a
+# larger one that still caps clients rotating their device id.
+RATE_LIMITS = {
+    "create_order": {"device": (10, 30), "ip": (100, 300)},
+    "create_activity_log": {"device": (30, 120), "ip": (300, 1200)},
+    "upload_menu": {"device": (2, 5), "ip": (5, 10)},
+    "reset": {"device": (2, 5), "ip": (5, 10)},
+    "reset_group": {"device": (2, 5), "ip": (10, 20)},
+    "delete_group": {"device": (2, 5), "ip": (10, 20)},
+}
+rate_limiters = {
+    name: {scope: TokenBucketLimiter(*budget) for scope, budget in budgets.items()}
+    for name, budgets in RATE_LIMITS.items()
+}
+
+def rate_limit(name: str):
+    """Dependency that rejects a client with 429 once its budget for this route is spent"""
+    limiters = rate_limiters[name]
+
+    async def check(request: Request):
+        client_ip = get_trusted_client_ip(request)
+        device_id = request.headers.get("X-Device-Id", "")
+        keys = {"device": f"{client_ip}|{device_id}", "ip": client_ip}
+        # Only spend tokens when both buckets allow the request, so a throttled device
+        # does not keep draining the budget it shares with colleagues behind the same IP
+        retry_after = max(limiters[scope].peek(key) for scope, key in keys.items())
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Te veel verzoeken, probeer het later opnieuw",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+        for scope, key in keys.items():
+            limiters[scope].consume(key)
+    return Depends(check)
+
+# Global cap on concurrently handled requests; excess load is shed with 503
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get('MAX_IN_FLIGHT_REQUESTS', '64'))
+in_flight_requests = 0
+
+# ===================== IDEMPOTENCY =====================
+
+# Replayed responses are kept in Mongo for a day and the most recent ones in process
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_LRU_SIZE = 1000
+# A claim whose request never finished (e.g. the worker restarted) can be taken over after this
+IDEMPOTENCY_LEASE_SECONDS = 30
+idempotency_lru = OrderedDict()
+
+def hash_request(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+def check_request_hash(record: dict, request_hash: str):
+    if record.get("request_hash") != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key is al gebruikt voor een ander verzoek")
+
+async def claim_idempotency_key(scope: str, key: str, payload: dict) -> Optional[dict]:
+    """Claim an Idempotency-Key for scope; returns the stored response if this is a replay"""
+    cache_key = f"{scope}:{key}"
+    request_hash = hash_request(payload)
+    if cache_key in idempotency_lru:
+        idempotency_lru.move_to_end(cache_key)
+        check_request_hash(idempotency_lru[cache_key], request_hash)
+        return idempotency_lru[cache_key]["response"]
+
+    now = datetime.now(timezone.utc)
+    lease = {"request_hash": request_hash, "locked_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+    try:
+        await db.idempotency_keys.insert_one({"key": cache_key, "response": None, "created_at": now, **lease})
+        return None
+    except DuplicateKeyError:
+        existing = await db.idempotency_keys.find_one({"key": cache_key}, {"_id": 0})
+        if not existing:
+            return await claim_idempotency_key(scope, key, payload)
+        check_request_hash(existing, request_hash)
+        if existing.get("response") is not None:
+            remember_idempotent_response(cache_key, existing)
+            return existing["response"]
+
+        # Still in progress: take over only when the previous claim's lease ran out
+        result = await db.idempotency_keys.update_one(
+            {"key": cache_key, "response": None, "locked_until": {"$lt": now}},
+            {"$set": lease}
+        )
+        if result.modified_count:
+            return None
+        raise HTTPException(
+            status_code=409,
+            detail="Dit verzoek wordt al verwerkt",
+            headers={"Retry-After": "1"}
+        )
+
+async def store_idempotent_response(scope: str, key: str, response: dict):
+    cache_key = f"{scope}:{key}"
+    record = await db.idempotency_keys.find_one_and_update(
+        {"key": cache_key},
+        {"$set": {"response": response}, "$unset": {"locked_until": ""}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if record:
+        remember_idempotent_response(cache_key, record)
+
+async def release_idempotency_key(scope: str, key: str):
+    """Forget a claimed key when the request failed, so the client can retry"""
+    await db.idempotency_keys.delete_one({"key": f"{scope}:{key}", "response": None})
+
+def remember_idempotent_response(cache_key: str, record: dict):
+    idempotency_lru[cache_key] = {"request_hash": record.get("request_hash"), "response": record["response"]}
+    idempotency_lru.move_to_end(cache_key)
+    if len(idempotency_lru) > IDEMPOTENCY_LRU_SIZE:
+        idempotency_lru.popitem(last=False)
+
+# ===================== SETTINGS CACHE =====================
+
+# Without a change stream, other workers' edits become visible after this many seconds
+SETTINGS_CACHE_TTL_SECONDS = 30
+_settings_cache = {"value": None, "loaded_at": 0.0, "watched": False}
+
+def cache_settings(settings: AppSettings):
+    """Store settings in the process cache unless a newer version is already cached"""
+    current = _settings_cache["value"]
+    if current is None or settings.version >= current.version:
+        _settings_cache["value"] = settings
+        _settings_cache["loaded_at"] = time.monotonic()
+
+async def get_cached_settings() -> AppSettings:
+    cached = _settings_cache["value"]
+    if cached is not None and (
+        _settings_cache["watched"]
+        or time.monotonic() - _settings_cache["loaded_at"] < SETTINGS_CACHE_TTL_SECONDS
+    ):
+        return cached
+
+    # Upsert with $setOnInsert so concurrent first requests cannot insert defaults twice
+    settings = await db.app_settings.find_one_and_update(
+        {"id": "app_settings"},
+        {"$setOnInsert": AppSettings().model_dump()},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # A newer version cached while this read was in flight wins
+    cache_settings(AppSettings(**settings))
+    return _settings_cache["value"]
+
+async def watch_settings_changes():
+    """Keep the settings cache in sync with edits made by other workers"""
+    try:
+        async with db.app_settings.watch(full_document="updateLookup") as stream:
+            # Edits made before the stream opened are not in it; reload once, then rely on the stream
+            _settings_cache["value"] = None
+            _settings_cache["watched"] = True
+            async for change in stream:
+                document = change.get("fullDocument")
+                if document:
+                    cache_settings(AppSettings(**document))
+                else:
+                    _settings_cache["value"] = None
+    except OperationFailure as e:
+        # Change streams need a replica set (Atlas has one, a local mongod may not)
+        logger.info(f"Settings change stream unavailable, using {SETTINGS_CACHE_TTL_SECONDS}s cache TTL: {e}")
+    except Exception as e:
+        logger.error(f"Settings change stream stopped: {str(e)}")
+    finally:
+        _settings_cache["watched"] = False
+
+# ===================== MENU CACHE & SEARCH =====================
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip accents and punctuation: 'Kaassoufflé (6)' -> 'kaassouffle 6'"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance that also counts swapping two adjacent letters as one edit"""
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+class MenuSearchIndex:
+    """Typo-tolerant prefix search over menu item names and categories using word n-grams"""
+
+    # Matching the category counts for less than matching the item name
+    CATEGORY_WEIGHT = 0.5
+
+    def __init__(self, items: list):
+        self.items = items
+        self.word_items = defaultdict(dict)
+        self.ngrams = defaultdict(set)
+        for idx, item in enumerate(items):
+            for weight, text in ((self.CATEGORY_WEIGHT, item["category"]), (1.0, item["name"])):
+                for word in normalize_text(text).split():
+                    self.word_items[word][idx] = max(weight, self.word_items[word].get(idx, 0))
+        for word in self.word_items:
+            for gram in self._ngrams(word, 2) | self._ngrams(word, 3):
+                self.ngrams[gram].add(word)
+        self.name_lengths = [len(normalize_text(item["name"])) for item in items]
+
+    @staticmethod
+    def _ngrams(word: str, n: int) -> set:
+        # Pad the start so the first letters of a word form their own n-gram
+        padded = f" {word}"
+        return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+    @staticmethod
+    def _match_score(token: str, word: str) -> float:
+        if word.startswith(token):
+            return 1.0 if len(word) > len(token) else 1.2
+        if len(token) < 3:
+            return 0
+        max_edits = 1 if len(token) <= 5 else 2
+        if len(word) < len(token) - max_edits:
+            return 0
+        # Compare against word prefixes one letter shorter/longer to allow a missing or extra letter
+        distance = min(
+            edit_distance(token, word[:length])
+            for length in (len(token) - 1, len(token), len(token) + 1)
+        )
+        return 1 - distance / (max_edits + 1) if distance <= max_edits else 0
+
+    def search(self, query: str, limit: int = 20, best_tier: bool = False) -> list:
+        tokens = normalize_text(query).split()
+        scores = None
+        for token in tokens:
+            # Only words sharing an n-gram with the token can be a (near) match
+            words = set()
+            for gram in self._ngrams(token, min(3, len(token) + 1)):
+                words |= self.ngrams.get(gram, set())
+
+            token_scores = {}
+            for word in words:
+                score = self._match_score(token, word)
+                if not score:
+                    continue
+                for idx, weight in self.word_items[word].items():
+                    token_scores[idx] = max(token_scores.get(idx, 0), score * weight)
+
+            # Every query word has to match something in the item
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {idx: score + token_scores[idx] for idx, score in scores.items() if idx in token_scores}
+
+        if not scores:
+            return []
+        if best_tier:
+            # Drop fuzzy hits when some items match every query word exactly or by prefix
+            top = max(scores.values())
+            floor = len(tokens) if top >= len(tokens) else top
+            scores = {idx: score for idx, score in scores.items() if score >= floor}
+        ranked = sorted(scores, key=lambda idx: (-scores[idx], self.name_lengths[idx], self.items[idx]["name"]))
+        return [self.items[idx] for idx in ranked[:limit]]
+
+# Menu items and their search index, keyed by menu version. The version is only
+# re-read after this many seconds, so other workers' menu edits show up within it
+MENU_CACHE_TTL_SECONDS = 30
+_menu_cache = {"key": None, "items": None, "index": None, "checked_at": 0.0}
+
+def invalidate_menu_cache():
+    _menu_cache["checked_at"] = 0.0
+
+async def get_cached_menu() -> dict:
+    if _menu_cache["items"] is not None and time.monotonic() - _menu_cache["checked_at"] < MENU_CACHE_TTL_SECONDS:
+        return _menu_cache
+
+    versions = await get_versions()
+    key = versions.get("menu", 0)
+    if _menu_cache["key"] == key:
+        _menu_cache["checked_at"] = time.monotonic()
+        return _menu_cache
 
-# Menu endpoints
-@api_router.get("/menu", response_model=List[MenuItem])
-async def get_menu():
     menu_items = await db.menu_items.find({}, {"_id": 0}).to_list(1000)
     if not menu_items:
         # Seed menu if empty
@@ -308,14 +852,94 @@ async def get_menu():
             menu_item = MenuItem(**item)
             await db.menu_items.insert_one(menu_item.model_dump())
         menu_items = await db.menu_items.find({}, {"_id": 0}).to_list(1000)
-    return menu_items
+
+    _menu_cache.update(key=key, items=menu_items, index=MenuSearchIndex(menu_items), checked_at=time.monotonic())
+    return _menu_cache
+
+# ===================== ACTIVITY LOG WRITER =====================
+
+# Entries recorded by mutating endpoints are written in batches by a background task
+ACTIVITY_QUEUE_SIZE = 1000
+ACTIVITY_BATCH_SIZE = 50
+activity_queue = asyncio.Queue(maxsize=ACTIVITY_QUEUE_SIZE)
+
+def get_device_info(request: Request) -> str:
+    """User agent plus the frontend's device id, in the format the activity log export parses"""
+    user_agent = request.headers.get("User-Agent", "")
+    device_id = request.headers.get("X-Device-Id")
+    return f"{user_agent} | DeviceID: {device_id}" if device_id else user_agent
+
+def log_activity(request: Request, action: str, details: str, order_id: Optional[str] = None):
+    """Queue an activity log entry without waiting for the database"""
+    entry = ActivityLogEntry(
+        action=action,
+        details=details,
+        order_id=order_id,
+        device_info=get_device_info(request),
+        client_ip=get_trusted_client_ip(request)
+    )
+    try:
+        activity_queue.put_nowait(entry.model_dump())
+    except asyncio.QueueFull:
+        logger.warning(f"Activity log queue full, dropping entry: {action} - {details}")
+
+async def write_activity_batch(entries: list):
+    try:
+        await db.activity_log.insert_many(entries)
+    except Exception as e:
+        logger.error(f"Error writing activity log: {str(e)}")
+
+# Queued on shutdown so the writer finishes its current batch and stops
+ACTIVITY_WRITER_STOP = None
+
+async def activity_log_writer():
+    while True:
+        entry = await activity_queue.get()
+        if entry is ACTIVITY_WRITER_STOP:
+            return
+        entries = [entry]
+        while len(entries) < ACTIVITY_BATCH_SIZE and not activity_queue.empty():
+            entry = activity_queue.get_nowait()
+            if entry is ACTIVITY_WRITER_STOP:
+                await write_activity_batch(entries)
+                return
+            entries.append(entry)
+        await write_activity_batch(entries)
+
+async def flush_activity_log():
+    """Write whatever is still queued, used on shutdown"""
+    entries = []
+    while not activity_queue.empty():
+        entries.append(activity_queue.get_nowait())
+    if entries:
+        await write_activity_batch(entries)
+
+# ===================== ROUTES =====================
+
+@api_router.get("/")
+async def root():
+    return {"message": "P&TA Snack Bestel App API"}
+
+# Menu endpoints
+@api_router.get("/menu", response_model=List[MenuItem])
+async def get_menu():
+    return (await get_cached_menu())["items"]
+
+@api_router.get("/menu/search", response_model=List[MenuItem])
+async def search_menu(q: str = "", limit: int = Query(20, ge=1, le=100)):
+    """Typo-tolerant, accent-insensitive search over menu items"""
+    menu = await get_cached_menu()
+    return menu["index"].search(q, limit)
 
 @api_router.post("/menu/seed")
-async def seed_menu():
+async def seed_menu(request: Request):
     await db.menu_items.delete_many({})
     for item in MENU_DATA:
         menu_item = MenuItem(**item)
         await db.menu_items.insert_one(menu_item.model_dump())
+    await bump_version("menu")
+    invalidate_menu_cache()
+    log_activity(request, "Menu bijgewerkt", f"Standaardmenu met {len(MENU_DATA)} items teruggezet")
     return {"message": f"Seeded {len(MENU_DATA)} menu items"}
 
 @api_router.get("/menu/download")
@@ -365,8 +989,8 @@ async def download_menu_excel():
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
-@api_router.post("/menu/upload")
-async def upload_menu_excel(file: UploadFile = File(...)):
+@api_router.post("/menu/upload", dependencies=[rate_limit("upload_menu")])
+async def upload_menu_excel(request: Request, file: UploadFile = File(...)):
     """Upload Excel file to replace the menu"""
     if not file.filename.endswith(('.xlsx', '.xls')):
         raise HTTPException(status_code=400, detail="Alleen Excel bestanden (.xlsx, .xls) zijn toegestaan")
@@ -410,6 +1034,9 @@ async def upload_menu_excel(file: UploadFile = File(...)):
         for item in new_menu_items:
             menu_item = MenuItem(**item)
             await db.menu_items.insert_one(menu_item.model_dump())
+        await bump_version("menu")
+        invalidate_menu_cache()
+        log_activity(request, "Menu bijgewerkt", f"{len(new_menu_items)} items geüpload")
         
         return {
             "message": f"Menu succesvol bijgewerkt met {len(new_menu_items)} items",
@@ -422,30 +1049,128 @@ async def upload_menu_excel(file: UploadFile = File(...)):
 
 # Order endpoints
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders():
-    orders = await db.orders.find({}, {"_id": 0}).to_list(1000)
-    return orders
+async def get_orders(group_id: str = DEFAULT_GROUP_ID):
+    return await get_orders_for_group(group_id)
+
+@api_router.get("/orders/search", response_model=List[Order])
+async def search_orders(
+    customer: Optional[str] = None,
+    item: Optional[str] = None,
+    is_paid: Optional[bool] = None,
+    group_id: str = DEFAULT_GROUP_ID
+):
+    """Filter a group's orders by customer name prefix, ordered item and paid status"""
+    await get_group(group_id)
+    query = {"group_id": group_id}
+    if customer:
+        query["search_name"] = {"$regex": f"^{re.escape(normalize_text(customer))}"}
+    if item:
+        # Resolve the (possibly misspelled) item through the menu index, then match exact names.
+        # Only the best matches count, so "frik" finds Frikandel orders but not Frietsaus ones
+        menu = await get_cached_menu()
+        names = [menu_item["name"] for menu_item in menu["index"].search(item, 50, best_tier=True)]
+        query["items.name"] = {"$in": names or [item]}
+    if is_paid is not None:
+        query["is_paid"] = is_paid
+    return await db.orders.find(query, {"_id": 0}).sort("created_at", 1).to_list(1000)
 
-@api_router.post("/orders", response_model=Order)
-async def create_order(order_data: OrderCreate):
+@api_router.get("/orders/email", response_model=OrderEmail)
+async def get_order_email(group_id: str = DEFAULT_GROUP_ID):
+    """Get the rendered order e-mail for the snack bar"""
+    rendered = await get_rendered_orders(group_id)
+    return OrderEmail(
+        order_email=rendered["order_email"],
+        subject=rendered["subject"],
+        body_text=rendered["email_text"],
+        body_html=rendered["email_html"]
+    )
+
+@api_router.get("/orders/receipt")
+async def get_order_receipt(
+    receipt_format: Literal["html", "text"] = Query("html", alias="format"),
+    group_id: str = DEFAULT_GROUP_ID
+):
+    """Get a print-friendly receipt of all orders in a group (html or text)"""
+    rendered = await get_rendered_orders(group_id)
+    if receipt_format == "text":
+        return PlainTextResponse(rendered["receipt_text"])
+    return HTMLResponse(rendered["receipt_html"])
+
+@api_router.post("/orders", response_model=Order, dependencies=[rate_limit("create_order")])
+async def create_order(order_data: OrderCreate, request: Request, idempotency_key: Optional[str] = Header(None)):
+    if idempotency_key:
+        replay = await claim_idempotency_key("create_order", idempotency_key, order_data.model_dump())
+        if replay is not None:
+            return Order(**replay)
+    
+    try:
+        await get_group(order_data.group_id)
+    except HTTPException:
+        if idempotency_key:
+            await release_idempotency_key("create_order", idempotency_key)
+        raise
+    
     items = [OrderItem(**item.model_dump()) for item in order_data.items]
     total_price = sum(item.quantity * item.price for item in items)
     
     order = Order(
+        group_id=order_data.group_id,
         customer_name=order_data.customer_name,
         items=items,
         total_price=total_price,
         remarks=order_data.remarks
     )
     
-    await db.orders.insert_one(order.model_dump())
+    try:
+        await db.orders.insert_one({**order.model_dump(), "search_name": normalize_text(order.customer_name)})
+    except Exception:
+        if idempotency_key:
+            await release_idempotency_key("create_order", idempotency_key)
+        raise
+    
+    # Store the response right away, so a later failure cannot leave the key unanswered
+    if idempotency_key:
+        await store_idempotent_response("create_order", idempotency_key, order.model_dump())
+    await bump_version(orders_version_key(order.group_id))
+    
+    items_list = ", ".join(f"{item.quantity}x {item.name}" for item in items)
+    remarks_text = f" ({order.remarks.strip()})" if order.remarks and order.remarks.strip() else ""
+    log_activity(request, "Bestelling geplaatst", f"{order.customer_name}: {items_list}{remarks_text}", order.id)
     return order
 
 @api_router.put("/orders/{order_id}", response_model=Order)
-async def update_order(order_id: str, order_update: OrderUpdate):
+async def update_order(order_id: str, order_update: OrderUpdate, request: Request, idempotency_key: Optional[str] = Header(None)):
+    scope = f"update_order:{order_id}"
+    if idempotency_key:
+        replay = await claim_idempotency_key(scope, idempotency_key, order_update.model_dump())
+        if replay is not None:
+            return Order(**replay)
+    
+    try:
+        updated = await apply_order_update(order_id, order_update)
+    except Exception:
+        if idempotency_key:
+            await release_idempotency_key(scope, idempotency_key)
+        raise
+    
+    if idempotency_key:
+        await store_idempotent_response(scope, idempotency_key, updated.model_dump())
+    await bump_version(orders_version_key(updated.group_id))
+    
+    if order_update.is_paid is not None:
+        paid_text = "Betaald" if order_update.is_paid else "Niet betaald"
+        log_activity(request, "Betaling gewijzigd", f"{updated.customer_name}: {paid_text}", order_id)
+    if order_update.items is not None:
+        log_activity(request, "Item aangepast", f"Bestelling van {updated.customer_name} gewijzigd", order_id)
+    if order_update.remarks is not None:
+        log_activity(request, "Opmerking gewijzigd", f"Opmerking bij bestelling van {updated.customer_name} gewijzigd", order_id)
+    return updated
+
+async def apply_order_update(order_id: str, order_update: OrderUpdate) -> Order:
     existing = await db.orders.find_one({"id": order_id}, {"_id": 0})
     if not existing:
         raise HTTPException(status_code=404, detail="Order not found")
+    check_order_version(existing, order_update.expected_version)
     
     update_data = {}
     if order_update.items is not None:
@@ -461,32 +1186,233 @@ async def update_order(order_id: str, order_update: OrderUpdate):
         update_data["remarks"] = order_update.remarks
     
     if update_data:
-        await db.orders.update_one({"id": order_id}, {"$set": update_data})
+        version_filter = {"version": order_update.expected_version} if order_update.expected_version is not None else {}
+        result = await db.orders.update_one(
+            {"id": order_id, **version_filter},
+            {"$set": update_data, "$inc": {"version": 1}}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=409, detail="Bestelling is intussen door iemand anders gewijzigd")
     
     updated = await db.orders.find_one({"id": order_id}, {"_id": 0})
     return Order(**updated)
 
+def check_order_version(order: dict, expected_version: Optional[int]):
+    if expected_version is not None and order.get("version", 0) != expected_version:
+        raise HTTPException(status_code=409, detail="Bestelling is intussen door iemand anders gewijzigd")
+
+def build_item_patch(order: dict, patch: OrderItemPatch) -> tuple:
+    """Translate an item patch into (update, item name, line removed) for one version-guarded update"""
+    items = order.get("items", [])
+    version_inc = {"version": 1}
+
+    if patch.index is not None:
+        if patch.index >= len(items):
+            raise HTTPException(status_code=404, detail="Item not found in order")
+        if items[patch.index]["menu_item_id"] != patch.menu_item_id:
+            raise HTTPException(status_code=409, detail="Bestelling is intussen door iemand anders gewijzigd")
+        index = patch.index
+    else:
+        index = next((i for i, item in enumerate(items) if item["menu_item_id"] == patch.menu_item_id), None)
+
+    if patch.op == "add" and index is None:
+        if patch.name is None or patch.price is None:
+            raise HTTPException(status_code=400, detail="name en price zijn verplicht voor een nieuw item")
+        item = OrderItem(menu_item_id=patch.menu_item_id, name=patch.name, quantity=patch.quantity, price=patch.price)
+        return (
+            {"$push": {"items": item.model_dump()},
+             "$set": {"total_price": round(order["total_price"] + item.quantity * item.price, 2)},
+             "$inc": version_inc},
+            item.name,
+            False
+        )
+
+    if index is None:
+        raise HTTPException(status_code=404, detail="Item not found in order")
+    line = items[index]
+
+    if patch.op in ("add", "increment"):
+        delta = patch.quantity
+    elif patch.op == "decrement" and line["quantity"] > patch.quantity:
+        delta = -patch.quantity
+    else:
+        # An order without lines would still show up in the e-mail and receipt
+        if len(items) == 1:
+            raise HTTPException(
+                status_code=400,
+                detail="Dit is het laatste item; verwijder de hele bestelling (DELETE /orders/{id})"
+            )
+        # Removing, or decrementing to zero, drops only this line; other lines for the
+        # same menu item stay. The version guard keeps the rewritten array consistent
+        return (
+            {"$set": {"items": items[:index] + items[index + 1:],
+                      "total_price": round(order["total_price"] - line["quantity"] * line["price"], 2)},
+             "$inc": version_inc},
+            line["name"],
+            True
+        )
+
+    # Address the line by position; the version guard ensures it is still the same line
+    return (
+        {"$set": {"total_price": round(order["total_price"] + delta * line["price"], 2)},
+         "$inc": {f"items.{index}.quantity": delta, **version_inc}},
+        line["name"],
+        False
+    )
+
+# Attempts before giving up when other edits keep winning the race
+ORDER_PATCH_ATTEMPTS = 3
+
+async def apply_item_patch(order_id: str, patch: OrderItemPatch) -> tuple:
+    """Apply the patch; returns the updated order, the patched item's name and whether its line was removed"""
+    for _ in range(ORDER_PATCH_ATTEMPTS):
+        existing = await db.orders.find_one({"id": order_id}, {"_id": 0})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Order not found")
+        check_order_version(existing, patch.expected_version)
+
+        update, item_name, removed = build_item_patch(existing, patch)
+        # Matching on the version read above makes the read-modify-write atomic
+        updated = await db.orders.find_one_and_update(
+            {"id": order_id, "version": existing.get("version", 0)},
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated:
+            return Order(**updated), item_name, removed
+        if patch.expected_version is not None:
+            break
+    raise HTTPException(status_code=409, detail="Bestelling is intussen door iemand anders gewijzigd")
+
+@api_router.patch("/orders/{order_id}/items", response_model=Order)
+async def patch_order_items(order_id: str, patch: OrderItemPatch, request: Request, idempotency_key: Optional[str] = Header(None)):
+    """Add, increment, decrement or remove a single order line"""
+    scope = f"patch_order_items:{order_id}"
+    if idempotency_key:
+        replay = await claim_idempotency_key(scope, idempotency_key, patch.model_dump())
+        if replay is not None:
+            return Order(**replay)
+    
+    try:
+        updated, item_name, removed = await apply_item_patch(order_id, patch)
+    except Exception:
+        if idempotency_key:
+            await release_idempotency_key(scope, idempotency_key)
+        raise
+    
+    if idempotency_key:
+        await store_idempotent_response(scope, idempotency_key, updated.model_dump())
+    await bump_version(orders_version_key(updated.group_id))
+    
+    if removed:
+        log_activity(request, "Item verwijderd", f"{item_name} verwijderd uit bestelling van {updated.customer_name}", order_id)
+    else:
+        log_activity(request, "Item aangepast", f"Aantal {item_name} gewijzigd in bestelling van {updated.customer_name}", order_id)
+    return updated
+
 @api_router.delete("/orders/{order_id}")
-async def delete_order(order_id: str):
-    result = await db.orders.delete_one({"id": order_id})
-    if result.deleted_count == 0:
+async def delete_order(order_id: str, request: Request):
+    deleted = await db.orders.find_one_and_delete({"id": order_id}, {"_id": 0, "group_id": 1, "customer_name": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Order not found")
+    await bump_version(orders_version_key(deleted.get("group_id", DEFAULT_GROUP_ID)))
+    log_activity(request, "Bestelling verwijderd", f"Bestelling van {deleted.get('customer_name')} verwijderd", order_id)
     return {"message": "Order deleted"}
 
+# Order group endpoints
+@api_router.get("/groups", response_model=List[OrderGroup])
+async def get_groups():
+    groups = await db.order_groups.find({}, {"_id": 0}).sort("created_at", 1).to_list(1000)
+    if not any(group["id"] == DEFAULT_GROUP_ID for group in groups):
+        groups.insert(0, (await get_group(DEFAULT_GROUP_ID)).model_dump())
+    return groups
+
+@api_router.post("/groups", response_model=OrderGroup)
+async def create_group(group_data: OrderGroupCreate):
+    group = OrderGroup(name=group_data.name, settings=group_data.settings or OrderGroupSettings())
+    await db.order_groups.insert_one(group.model_dump())
+    return group
+
+@api_router.get("/groups/{group_id}", response_model=OrderGroup)
+async def get_group_by_id(group_id: str):
+    return await get_group(group_id)
+
+@api_router.put("/groups/{group_id}", response_model=OrderGroup)
+async def update_group(group_id: str, group_update: OrderGroupUpdate):
+    group = await get_group(group_id)
+    if group_update.name is not None:
+        group.name = group_update.name
+    if group_update.settings is not None:
+        group.settings = group_update.settings
+    
+    await db.order_groups.replace_one({"id": group_id}, group.model_dump(), upsert=True)
+    await bump_version(group_version_key(group_id))
+    return group
+
+@api_router.delete("/groups/{group_id}", dependencies=[rate_limit("delete_group")])
+async def delete_group(group_id: str, request: Request):
+    """Delete a group together with its orders"""
+    if group_id == DEFAULT_GROUP_ID:
+        raise HTTPException(status_code=400, detail="De standaardgroep kan niet verwijderd worden")
+    result = await db.order_groups.delete_one({"id": group_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Group not found")
+    await db.orders.delete_many({"group_id": group_id})
+    await bump_version(orders_version_key(group_id), group_version_key(group_id))
+    log_activity(request, "Groep verwijderd", f"Groep {group_id} en bijbehorende bestellingen verwijderd")
+    return {"message": "Group deleted"}
+
+@api_router.get("/groups/{group_id}/settings", response_model=AppSettings)
+async def get_group_settings(group_id: str):
+    """App-wide settings with the group's overrides (payment link, e-mail texts) applied"""
+    group = await get_group(group_id)
+    return apply_group_settings(await get_cached_settings(), group)
+
+@api_router.get("/groups/{group_id}/orders", response_model=List[Order])
+async def get_orders_for_group(group_id: str):
+    await get_group(group_id)
+    return await get_group_orders(group_id)
+
+@api_router.get("/groups/{group_id}/summary", response_model=OrderGroupSummary)
+async def get_group_summary(group_id: str):
+    """Aggregated totals for one group"""
+    await get_group(group_id)
+    orders = await get_group_orders(group_id)
+    lines = aggregate_order_lines(orders)
+    return OrderGroupSummary(
+        group_id=group_id,
+        order_count=len(orders),
+        paid_count=sum(1 for order in orders if order.get("is_paid")),
+        grand_total=sum(order.get("total_price", 0) for order in orders),
+        items=[
+            OrderSummaryLine(
+                name=line["name"],
+                remarks=line["remarks"],
+                quantity=line["quantity"],
+                subtotal=line["quantity"] * line["price"]
+            )
+            for line in lines
+        ]
+    )
+
+@api_router.post("/groups/{group_id}/reset", dependencies=[rate_limit("reset_group")])
+async def reset_group(group_id: str, request: Request):
+    group = await get_group(group_id)
+    result = await db.orders.delete_many({"group_id": group_id})
+    await bump_version(orders_version_key(group_id))
+    log_activity(request, "Groep gereset", f"Alle bestellingen van {group.name} verwijderd")
+    return {"message": f"{result.deleted_count} orders have been reset"}
+
 # Activity Log endpoints
 @api_router.get("/activity-log", response_model=List[ActivityLogEntry])
 async def get_activity_log():
     logs = await db.activity_log.find({}, {"_id": 0}).sort("timestamp", -1).to_list(1000)
     return logs
 
-@api_router.post("/activity-log", response_model=ActivityLogEntry)
+@api_router.post("/activity-log", response_model=ActivityLogEntry, dependencies=[rate_limit("create_activity_log")])
 async def create_activity_log(log_data: ActivityLogCreate, request: Request):
-    # Get client IP from various headers (handles proxies)
-    client_ip = request.headers.get("X-Forwarded-For", "").split(",")[0].strip()
-    if not client_ip:
-        client_ip = request.headers.get("X-Real-IP", "")
-    if not client_ip:
-        client_ip = request.client.host if request.client else "unknown"
+    client_ip = get_trusted_client_ip(request)
     
     entry_data = log_data.model_dump()
     entry_data["client_ip"] = client_ip
@@ -497,21 +1423,10 @@ async def create_activity_log(log_data: ActivityLogCreate, request: Request):
 # App Settings endpoints
 @api_router.get("/settings", response_model=AppSettings)
 async def get_settings():
-    settings = await db.app_settings.find_one({"id": "app_settings"}, {"_id": 0})
-    if not settings:
-        default_settings = AppSettings()
-        await db.app_settings.insert_one(default_settings.model_dump())
-        return default_settings
-    return AppSettings(**settings)
+    return await get_cached_settings()
 
 @api_router.put("/settings", response_model=AppSettings)
-async def update_settings(settings_update: AppSettingsUpdate):
-    existing = await db.app_settings.find_one({"id": "app_settings"}, {"_id": 0})
-    if not existing:
-        default_settings = AppSettings()
-        await db.app_settings.insert_one(default_settings.model_dump())
-        existing = default_settings.model_dump()
-    
+async def update_settings(settings_update: AppSettingsUpdate, request: Request):
     update_data = {}
     if settings_update.payment_link is not None:
         update_data["payment_link"] = settings_update.payment_link
@@ -526,11 +1441,29 @@ async def update_settings(settings_update: AppSettingsUpdate):
     if settings_update.email_outro is not None:
         update_data["email_outro"] = settings_update.email_outro
     
-    if update_data:
-        await db.app_settings.update_one({"id": "app_settings"}, {"$set": update_data})
+    if not update_data:
+        return await get_cached_settings()
     
-    updated = await db.app_settings.find_one({"id": "app_settings"}, {"_id": 0})
-    return AppSettings(**updated)
+    defaults = AppSettings().model_dump(exclude={"version", *update_data})
+    updated = await db.app_settings.find_one_and_update(
+        {"id": "app_settings"},
+        {"$set": update_data, "$inc": {"version": 1}, "$setOnInsert": defaults},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    settings = AppSettings(**updated)
+    cache_settings(settings)
+    
+    if "payment_link" in update_data:
+        log_activity(request, "Instellingen gewijzigd", "Betaalverzoek link bijgewerkt")
+    if "is_edit_mode" in update_data:
+        log_activity(request, "Instellingen gewijzigd", f"Bewerkmodus {'aan' if update_data['is_edit_mode'] else 'uit'}")
+    if "order_email" in update_data:
+        log_activity(request, "Instellingen gewijzigd", "Bestel e-mail bijgewerkt")
+    if update_data.keys() & {"email_subject", "email_intro", "email_outro"}:
+        log_activity(request, "Instellingen gewijzigd", "E-mail template bijgewerkt")
+    return settings
 
 # Admin verification
 @api_router.post("/admin/verify")
@@ -539,15 +1472,34 @@ async def verify_admin(data: AdminVerify):
         return {"success": True}
     return {"success": False}
 
-# Reset app
-@api_router.post("/reset")
-async def reset_app():
-    await db.orders.delete_many({})
+# Reset app; only the default group, other groups are reset through /groups/{id}/reset
+@api_router.post("/reset", dependencies=[rate_limit("reset")])
+async def reset_app(request: Request):
+    await db.orders.delete_many({"group_id": DEFAULT_GROUP_ID})
+    await bump_version(orders_version_key(DEFAULT_GROUP_ID))
+    log_activity(request, "App gereset", "Alle bestellingen van de standaardgroep verwijderd")
     return {"message": "All orders have been reset"}
 
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.middleware("http")
+async def shed_load(request: Request, call_next):
+    """Reject requests early when too many are already in flight"""
+    global in_flight_requests
+    if request.url.path != "/health" and in_flight_requests >= MAX_IN_FLIGHT_REQUESTS:
+        logger.warning(f"Shedding load: {in_flight_requests} requests in flight")
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server is druk, probeer het zo opnieuw"},
+            headers={"Retry-After": "1"}
+        )
+    in_flight_requests += 1
+    try:
+        return await call_next(request)
+    finally:
+        in_flight_requests -= 1
+
 # CORS configuration - allow GitHub Pages and localhost for development
 cors_origins = os.environ.get('CORS_ORIGINS', '*')
 if cors_origins == '*':
@@ -568,6 +1520,45 @@ app.add_middleware(
 async def health_check():
     return {"status": "healthy", "service": "P&TA Snack Bestel App API"}
 
+@app.on_event("startup")
+async def create_indexes():
+    # Orders from before order groups existed belong to the default group
+    await db.orders.update_many({"group_id": {"$exists": False}}, {"$set": {"group_id": DEFAULT_GROUP_ID}})
+    await db.orders.update_many({"version": {"$exists": False}}, {"$set": {"version": 0}})
+    await db.orders.create_index([("group_id", 1), ("created_at", 1)])
+    # Order versions used to be a single counter; they are tracked per group now
+    await db.app_state.update_one(
+        {"id": "versions", "orders": {"$not": {"$type": "object"}}},
+        {"$unset": {"orders": ""}}
+    )
+    await db.orders.create_index("id")
+    await db.orders.create_index([("group_id", 1), ("search_name", 1)])
+    await db.orders.create_index([("group_id", 1), ("items.name", 1)])
+    await db.orders.create_index([("group_id", 1), ("is_paid", 1), ("created_at", 1)])
+    async for order in db.orders.find({"search_name": {"$exists": False}}, {"id": 1, "customer_name": 1}):
+        await db.orders.update_one(
+            {"_id": order["_id"]},
+            {"$set": {"search_name": normalize_text(order.get("customer_name", ""))}}
+        )
+    await db.order_groups.create_index("id", unique=True)
+    await db.idempotency_keys.create_index("key", unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    try:
+        await db.app_settings.create_index("id", unique=True)
+    except OperationFailure as e:
+        logger.warning(f"Could not create unique settings index: {str(e)}")
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.settings_watcher = asyncio.create_task(watch_settings_changes())
+    app.state.activity_writer = asyncio.create_task(activity_log_writer())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.settings_watcher.cancel()
+    # Cancelling could lose a batch that is being written; let the writer stop by itself
+    if not app.state.activity_writer.done():
+        await activity_queue.put(ACTIVITY_WRITER_STOP)
+        await app.state.activity_writer
+    await flush_activity_log()
     client.close()
@@ -10,11 +10,12 @@ class PnTASnackAPITester:
         self.tests_passed = 0
         self.failed_tests = []
         self.test_results = {}
+        self.last_response = None
 
-    def run_test(self, name, method, endpoint, expected_status, data=None):
+    def run_test(self, name, method, endpoint, expected_status, data=None, extra_headers=None):
         """Run a single API test"""
         url = f"{self.base_url}/{endpoint}"
-        headers = {'Content-Type': 'application/json'}
+        headers = {'Content-Type': 'application/json', **(extra_headers or {})}
 
         self.tests_run += 1
         print(f"\n🔍 Testing {name}...")
@@ -26,8 +27,11 @@ class PnTASnackAPITester:
                 response = requests.post(url, json=data, headers=headers)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=headers)
             elif method == 'DELETE':
                 response = requests.delete(url, headers=headers)
+            self.last_response = response
 
             success = response.status_code == expected_status
             if success:
@@ -73,6 +77,18 @@ class PnTASnackAPITester:
             return success, response
         return success, response
 
+    def test_menu_search(self):
+        """Test typo-tolerant menu search"""
+        success, response = self.run_test("Search Menu (typo)", "GET", "menu/search?q=korket", 200)
+        if success:
+            names = [item.get('name') for item in response]
+            print(f"   'korket' matched: {names[:5]}")
+            if "Kroket" not in names:
+                print("   ❌ Expected 'Kroket' in search results")
+                return False, response
+        limit_ok, _ = self.run_test("Search Menu (invalid limit)", "GET", "menu/search?q=kroket&limit=0", 422)
+        return success and limit_ok, response
+
     def test_seed_menu(self):
         """Test menu seeding"""
         return self.run_test("Seed Menu", "POST", "menu/seed", 200)
@@ -139,6 +155,167 @@ class PnTASnackAPITester:
         
         return True
 
+    def test_idempotent_order_creation(self):
+        """Test that replaying an Idempotency-Key returns the original order"""
+        print("\n🔁 Testing Idempotency Keys...")
+        
+        key = {"Idempotency-Key": f"test-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"}
+        test_order = {
+            "customer_name": "Test Idempotent",
+            "items": [{"menu_item_id": "test-id-1", "name": "Frikandel", "quantity": 1, "price": 2.25}]
+        }
+        success, first = self.run_test("Create Order (key)", "POST", "orders", 200, test_order, key)
+        if not success:
+            return False
+        
+        success, replay = self.run_test("Create Order (replay)", "POST", "orders", 200, test_order, key)
+        if success and replay.get('id') != first.get('id'):
+            print("   ❌ Replay created a new order")
+            success = False
+        
+        different = {**test_order, "customer_name": "Iemand Anders"}
+        mismatch_ok, _ = self.run_test("Create Order (key reused, other body)", "POST", "orders", 422, different, key)
+        
+        self.run_test("Delete Idempotent Order", "DELETE", f"orders/{first.get('id')}", 200)
+        return success and mismatch_ok
+
+    def test_order_item_patch(self):
+        """Test changing single order lines with PATCH /orders/{id}/items"""
+        print("\n🩹 Testing Order Item Patches...")
+        
+        # Two lines for the same menu item, e.g. one with and one without sauce
+        test_order = {
+            "customer_name": "Test Patch",
+            "items": [
+                {"menu_item_id": "test-id-1", "name": "Frikandel", "quantity": 1, "price": 2.25},
+                {"menu_item_id": "test-id-1", "name": "Frikandel", "quantity": 2, "price": 2.25}
+            ]
+        }
+        success, order = self.run_test("Create Order (patch)", "POST", "orders", 200, test_order)
+        if not success:
+            return False
+        order_id = order['id']
+        endpoint = f"orders/{order_id}/items"
+        results = []
+        
+        def check(label, ok):
+            if not ok:
+                print(f"   ❌ {label}")
+            results.append(ok)
+        
+        new_item = {"op": "add", "menu_item_id": "test-id-2", "name": "Kroket", "price": 2.5, "quantity": 1}
+        ok, order = self.run_test("Patch Add Item", "PATCH", endpoint, 200, new_item)
+        check("Kroket line not added", ok and [i['name'] for i in order['items']] == ["Frikandel", "Frikandel", "Kroket"])
+        
+        ok, order = self.run_test("Patch Increment Second Line", "PATCH", endpoint, 200,
+                                  {"op": "increment", "menu_item_id": "test-id-1", "index": 1})
+        check("Wrong line incremented", ok and [i['quantity'] for i in order['items']] == [1, 3, 1])
+        
+        stale = {"op": "increment", "menu_item_id": "test-id-1", "index": 0, "expected_version": order.get('version', 0) - 1}
+        ok, _ = self.run_test("Patch With Stale Version", "PATCH", endpoint, 409, stale)
+        check("Stale expected_version accepted", ok)
+        
+        ok, order = self.run_test("Patch Decrement To Zero", "PATCH", endpoint, 200,
+                                  {"op": "decrement", "menu_item_id": "test-id-1", "index": 0, "expected_version": order.get('version')})
+        check("Decrement removed more than one line", ok and [i['quantity'] for i in order['items']] == [3, 1])
+        
+        ok, order = self.run_test("Patch Remove Item", "PATCH", endpoint, 200,
+                                  {"op": "remove", "menu_item_id": "test-id-2", "index": 1})
+        check("Kroket line not removed", ok and [i['name'] for i in order['items']] == ["Frikandel"])
+        if ok:
+            check("Total not updated", abs(order['total_price'] - 6.75) < 0.01)
+        
+        ok, _ = self.run_test("Patch Remove Last Item", "PATCH", endpoint, 400,
+                              {"op": "remove", "menu_item_id": "test-id-1", "index": 0})
+        check("Last line removed, leaving an empty order", ok)
+        
+        self.run_test("Delete Patched Order", "DELETE", f"orders/{order_id}", 200)
+        return all(results)
+
+    def test_order_email_and_receipt(self):
+        """Test server-rendered order e-mail and receipt"""
+        print("\n✉️ Testing Order E-mail & Receipt...")
+        
+        success, email = self.run_test("Get Order E-mail", "GET", "orders/email", 200)
+        if success:
+            print(f"   Subject: {email.get('subject')}, to: {email.get('order_email')}")
+            if "Totaal:" not in email.get('body_text', ''):
+                print("   ❌ E-mail body is missing the total")
+                return False
+        
+        success_receipt, _ = self.run_test("Get Receipt (HTML)", "GET", "orders/receipt", 200)
+        success_text, _ = self.run_test("Get Receipt (Text)", "GET", "orders/receipt?format=text", 200)
+        success_invalid, _ = self.run_test("Get Receipt (invalid format)", "GET", "orders/receipt?format=pdf", 422)
+        
+        return success and success_receipt and success_text and success_invalid
+
+    def test_order_groups(self):
+        """Test group-scoped orders, summary and reset"""
+        print("\n👥 Testing Order Groups...")
+        
+        success, group = self.run_test("Create Group", "POST", "groups", 200, {"name": "Test Groep"})
+        if not success or not group.get('id'):
+            return False
+        group_id = group['id']
+        
+        test_order = {
+            "customer_name": "Test Groepslid",
+            "group_id": group_id,
+            "items": [{"menu_item_id": "test-id-1", "name": "Frikandel", "quantity": 2, "price": 2.25}]
+        }
+        self.run_test("Create Group Order", "POST", "orders", 200, test_order)
+        
+        success, summary = self.run_test("Get Group Summary", "GET", f"groups/{group_id}/summary", 200)
+        if success:
+            print(f"   Group has {summary.get('order_count')} orders, total {summary.get('grand_total')}")
+        
+        # Resetting the app only clears the default group
+        self.run_test("Reset App (default group)", "POST", "reset", 200)
+        kept_ok, orders = self.run_test("Get Group Orders (after app reset)", "GET", f"groups/{group_id}/orders", 200)
+        if kept_ok and len(orders) != 1:
+            print("   ❌ App reset removed another group's orders")
+            kept_ok = False
+        
+        link = "https://betaal.example/groep"
+        self.run_test("Set Group Payment Link", "PUT", f"groups/{group_id}", 200, {"settings": {"payment_link": link}})
+        settings_ok, group_settings = self.run_test("Get Group Settings", "GET", f"groups/{group_id}/settings", 200)
+        if settings_ok and group_settings.get('payment_link') != link:
+            print("   ❌ Group payment link override not applied")
+            settings_ok = False
+        
+        self.run_test("Reset Group", "POST", f"groups/{group_id}/reset", 200)
+        success, _ = self.run_test("Delete Group", "DELETE", f"groups/{group_id}", 200)
+        
+        return success and kept_ok and settings_ok
+
+    def test_rate_limiting(self):
+        """Test that a client exceeding its reset budget gets 429 with Retry-After"""
+        print("\n🚦 Testing Rate Limiting...")
+        
+        success, group = self.run_test("Create Group (rate limit)", "POST", "groups", 200, {"name": "Rate Limit Test"})
+        if not success:
+            return False
+        group_id = group['id']
+        
+        # Fresh device id, so earlier tests have not spent this budget; burst capacity is 2
+        device = {"X-Device-Id": f"TEST-{datetime.now().strftime('%H%M%S%f')}"}
+        self.run_test("Reset Group (1)", "POST", f"groups/{group_id}/reset", 200, extra_headers=device)
+        self.run_test("Reset Group (2)", "POST", f"groups/{group_id}/reset", 200, extra_headers=device)
+        success, _ = self.run_test("Reset Group (over budget)", "POST", f"groups/{group_id}/reset", 429, extra_headers=device)
+        if success:
+            print(f"   Retry-After: {self.last_response.headers.get('Retry-After')}")
+            success = self.last_response.headers.get('Retry-After') is not None
+        
+        # A device stuck in a retry loop must not use up the budget its office IP shares
+        for _ in range(10):
+            requests.post(f"{self.base_url}/groups/{group_id}/reset", headers=device)
+        other_device = {"X-Device-Id": f"TEST-OTHER-{datetime.now().strftime('%H%M%S%f')}"}
+        other_ok, _ = self.run_test("Reset Group (other device)", "POST", f"groups/{group_id}/reset", 200, extra_headers=other_device)
+        success = success and other_ok
+        
+        self.run_test("Delete Group (rate limit)", "DELETE", f"groups/{group_id}", 200)
+        return success
+
     def test_activity_log(self):
         """Test activity log functionality"""
         print("\n📊 Testing Activity Log...")
@@ -150,9 +327,8 @@ class PnTASnackAPITester:
         
         # Create new log entry
         log_entry = {
-            "action": "Test Actie",
+            "action": "Admin login",
             "details": "Test activiteit voor API testing",
-            "order_id": "test-order-123",
             "device_info": "Test Agent Browser"
         }
         success, new_log = self.run_test("Create Activity Log", "POST", "activity-log", 200, log_entry)
@@ -160,7 +336,11 @@ class PnTASnackAPITester:
         if success:
             print(f"   Created log entry with ID: {new_log.get('id')}")
         
-        return success
+        # Order changes are logged by the server; clients cannot record them
+        forged = {**log_entry, "action": "Bestelling verwijderd", "order_id": "test-order-123"}
+        rejected, _ = self.run_test("Create Activity Log (server-only action)", "POST", "activity-log", 422, forged)
+        
+        return success and rejected
 
     def test_settings(self):
         """Test app settings functionality"""
@@ -185,6 +365,19 @@ class PnTASnackAPITester:
         if success:
             print(f"   Updated edit mode: {updated_settings.get('is_edit_mode')}")
         
+        # Settings are cached; a change must show up right away in reads and the rendered e-mail
+        intro = f"Test intro {datetime.now().strftime('%H%M%S')}"
+        success, updated_settings = self.run_test("Update E-mail Intro", "PUT", "settings", 200, {"email_intro": intro})
+        if success:
+            _, reread = self.run_test("Get Settings (after update)", "GET", "settings", 200)
+            _, email = self.run_test("Get Order E-mail (after update)", "GET", "orders/email", 200)
+            if reread.get('email_intro') != intro or not email.get('body_text', '').startswith(intro):
+                print("   ❌ Updated intro not visible in settings or e-mail")
+                success = False
+            if updated_settings.get('version', 0) <= settings.get('version', 0):
+                print("   ❌ Settings version did not increase")
+                success = False
+        
         return success
 
     def test_admin_verification(self):
@@ -224,7 +417,13 @@ class PnTASnackAPITester:
         test_functions = [
             self.test_api_root,
             self.test_menu_endpoint,
+            self.test_menu_search,
             self.test_orders_crud,
+            self.test_idempotent_order_creation,
+            self.test_order_item_patch,
+            self.test_order_email_and_receipt,
+            self.test_order_groups,
+            self.test_rate_limiting,
             self.test_activity_log,
             self.test_settings,
             self.test_admin_verification,
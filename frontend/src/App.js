@@ -149,6 +149,34 @@ const getDeviceId = () => {
   return deviceId;
 };
 
+// Send the device ID with every request so the backend can attribute activity log entries
+axios.defaults.headers.common["X-Device-Id"] = getDeviceId();
+
+// Send a write for one user action, retrying on timeouts, network errors and overload.
+// Every attempt carries the same Idempotency-Key, so the backend applies it only once.
+const WRITE_ATTEMPTS = 3;
+const WRITE_TIMEOUT_MS = 8000;
+
+const sendIdempotent = async (request) => {
+  const config = {
+    timeout: WRITE_TIMEOUT_MS,
+    headers: {
+      "Idempotency-Key": `${Date.now().toString(36)}-${Math.random().toString(36).substring(2, 12)}`,
+    },
+  };
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await request(config);
+    } catch (error) {
+      const status = error.response?.status;
+      // 409 with Retry-After means the first attempt is still being processed
+      const retryable = !error.response || status === 503 || (status === 409 && error.response.headers["retry-after"]);
+      if (!retryable || attempt >= WRITE_ATTEMPTS) throw error;
+      await new Promise((resolve) => setTimeout(resolve, 500 * attempt));
+    }
+  }
+};
+
 function App() {
   // State
   const [menu, setMenu] = useState([]);
@@ -263,7 +291,7 @@ function App() {
     return orders.reduce((sum, order) => sum + order.total_price, 0);
   }, [orders]);
 
-  // Log activity
+  // Log client-side activity (mutations are logged by the backend itself)
   const logActivity = useCallback(async (action, details, orderId = null) => {
     try {
       const entry = {
@@ -335,14 +363,9 @@ function App() {
         items: validItems,
         remarks: orderRemarks.trim() || null,
       };
-      const res = await axios.post(`${API}/orders`, orderData);
+      const res = await sendIdempotent((config) => axios.post(`${API}/orders`, orderData, config));
       setOrders([...orders, res.data]);
       
-      // Create detailed log with ordered items
-      const itemsList = validItems.map(item => `${item.quantity}x ${item.name}`).join(", ");
-      const remarksText = orderRemarks.trim() ? ` (${orderRemarks.trim()})` : "";
-      logActivity("Bestelling geplaatst", `${customerName}: ${itemsList}${remarksText}`, res.data.id);
-      
       const nameLower = customerName.trim().toLowerCase();
       
       // Easter egg for Jilles
@@ -382,14 +405,11 @@ function App() {
   // Handle payment status change
   const handlePaymentStatusChange = async (orderId, isPaid) => {
     try {
-      const res = await axios.put(`${API}/orders/${orderId}`, { is_paid: isPaid });
+      const res = await sendIdempotent((config) =>
+        axios.put(`${API}/orders/${orderId}`, { is_paid: isPaid }, config)
+      );
       setOrders(orders.map((o) => (o.id === orderId ? res.data : o)));
       const order = orders.find((o) => o.id === orderId);
-      logActivity(
-        "Betaling gewijzigd",
-        `${order.customer_name}: ${isPaid ? "Betaald" : "Niet betaald"}`,
-        orderId
-      );
       toast.success(`Betalingsstatus van ${order.customer_name} bijgewerkt`);
     } catch (error) {
       console.error("Error updating payment status:", error);
@@ -412,13 +432,23 @@ function App() {
       return;
     }
 
+    const item = order.items[itemIndex];
+    const delta = Math.max(0, newQuantity) - item.quantity;
+    if (delta === 0) return;
+    const patch = {
+      op: newQuantity <= 0 ? "remove" : delta > 0 ? "increment" : "decrement",
+      menu_item_id: item.menu_item_id,
+      index: itemIndex,
+      quantity: Math.abs(delta),
+      expected_version: order.version,
+    };
+
     try {
-      const res = await axios.put(`${API}/orders/${orderId}`, { items: updatedItems });
+      const res = await sendIdempotent((config) => axios.patch(`${API}/orders/${orderId}/items`, patch, config));
       setOrders(orders.map((o) => (o.id === orderId ? res.data : o)));
-      logActivity("Item aangepast", `Aantal gewijzigd in bestelling van ${order.customer_name}`, orderId);
     } catch (error) {
       console.error("Error updating order:", error);
-      toast.error("Fout bij bijwerken bestelling");
+      toast.error(error.response?.data?.detail || "Fout bij bijwerken bestelling");
     }
   };
 
@@ -426,7 +456,7 @@ function App() {
   const confirmDeleteItem = async () => {
     if (!itemToDelete) return;
 
-    const { orderId, itemIndex, itemName, customerName: orderCustomerName } = itemToDelete;
+    const { orderId, itemIndex } = itemToDelete;
     const order = orders.find((o) => o.id === orderId);
     if (!order) return;
 
@@ -436,13 +466,18 @@ function App() {
       await handleDeleteOrder(orderId);
     } else {
       try {
-        const res = await axios.put(`${API}/orders/${orderId}`, { items: updatedItems });
+        const patch = {
+          op: "remove",
+          menu_item_id: order.items[itemIndex].menu_item_id,
+          index: itemIndex,
+          expected_version: order.version,
+        };
+        const res = await sendIdempotent((config) => axios.patch(`${API}/orders/${orderId}/items`, patch, config));
         setOrders(orders.map((o) => (o.id === orderId ? res.data : o)));
-        logActivity("Item verwijderd", `${itemName} verwijderd uit bestelling van ${orderCustomerName}`, orderId);
         toast.success("Item verwijderd");
       } catch (error) {
         console.error("Error deleting item:", error);
-        toast.error("Fout bij verwijderen item");
+        toast.error(error.response?.data?.detail || "Fout bij verwijderen item");
       }
     }
     setItemToDelete(null);
@@ -451,10 +486,8 @@ function App() {
   // Handle delete order
   const handleDeleteOrder = async (orderId) => {
     try {
-      const order = orders.find((o) => o.id === orderId);
       await axios.delete(`${API}/orders/${orderId}`);
       setOrders(orders.filter((o) => o.id !== orderId));
-      logActivity("Bestelling verwijderd", `Bestelling van ${order?.customer_name} verwijderd`, orderId);
       toast.success("Bestelling verwijderd");
     } catch (error) {
       console.error("Error deleting order:", error);
@@ -491,7 +524,6 @@ function App() {
     try {
       const res = await axios.put(`${API}/settings`, { payment_link: tempPaymentLink });
       setSettings(res.data);
-      logActivity("Instellingen gewijzigd", "Betaalverzoek link bijgewerkt");
       toast.success("Link opgeslagen");
     } catch (error) {
       toast.error("Fout bij opslaan link");
@@ -513,7 +545,6 @@ function App() {
     try {
       await axios.post(`${API}/reset`);
       setOrders([]);
-      logActivity("App gereset", "Alle bestellingen verwijderd");
       toast.success("App is gereset");
       setIsResetConfirmVisible(false);
     } catch (error) {
@@ -521,6 +552,17 @@ function App() {
     }
   };
 
+  // Open activity log with the latest server-side entries
+  const handleOpenLog = async () => {
+    setIsLogVisible(true);
+    try {
+      const res = await axios.get(`${API}/activity-log`);
+      setActivityLog(res.data);
+    } catch (error) {
+      console.error("Error fetching activity log:", error);
+    }
+  };
+
   // Export activity log to CSV
   const handleExportLog = () => {
     const headers = ["Timestamp", "Action", "Details", "Order ID", "Device", "Browser", "Device ID", "IP Address"];
@@ -580,7 +622,6 @@ function App() {
         headers: { 'Content-Type': 'multipart/form-data' }
       });
       toast.success(response.data.message);
-      logActivity("Menu bijgewerkt", `${response.data.count} items geüpload`);
       
       // Refresh menu
       const menuRes = await axios.get(`${API}/menu`);
@@ -597,56 +638,22 @@ function App() {
     }
   };
 
-  // Export to email
-  const handleExportEmail = () => {
-    // Build totals with remarks separated
-    // Group items by name + remarks combination
-    const itemsWithRemarks = {};
-    
-    orders.forEach((order) => {
-      order.items.forEach((item) => {
-        // Create a unique key: item name + remarks (if any from the order)
-        const remarks = order.remarks?.trim() || "";
-        const key = remarks ? `${item.name}|||${remarks}` : item.name;
-        
-        if (!itemsWithRemarks[key]) {
-          itemsWithRemarks[key] = {
-            name: item.name,
-            remarks: remarks,
-            quantity: 0,
-            price: item.price
-          };
-        }
-        itemsWithRemarks[key].quantity += item.quantity;
-      });
-    });
-    
-    // Sort: items without remarks first, then with remarks
-    const sortedItems = Object.values(itemsWithRemarks).sort((a, b) => {
-      if (!a.remarks && b.remarks) return -1;
-      if (a.remarks && !b.remarks) return 1;
-      return a.name.localeCompare(b.name);
-    });
-    
-    // Build the totals text
-    const totalsText = sortedItems
-      .map((item) => {
-        const remarksText = item.remarks ? ` - ${item.remarks}` : "";
-        const subtotal = item.quantity * item.price;
-        return `${item.quantity}x ${item.name}${remarksText} - ${formatPrice(subtotal)}`;
-      })
-      .join("\n");
-    
-    // Use customizable email template
-    const intro = settings.email_intro || "Hierbij de bestelling voor vandaag:";
-    const outro = settings.email_outro || "Graag zo snel mogelijk bezorgen. Alvast bedankt!";
-    const subject = settings.email_subject || "Bestelling P&TA";
-    
-    const body = `${intro}\n\n${totalsText}\n\nTotaal: ${formatPrice(grandTotal)}\n\n${outro}`;
-    
-    const emailAddress = settings.order_email || "info@cafetariarex.nl";
-    const mailto = `mailto:${emailAddress}?subject=${encodeURIComponent(subject)}&body=${encodeURIComponent(body)}`;
-    window.location.href = mailto;
+  // Export to email (rendered server-side so every device sends the same text)
+  const handleExportEmail = async () => {
+    try {
+      const res = await axios.get(`${API}/orders/email`);
+      const { order_email, subject, body_text } = res.data;
+      const mailto = `mailto:${order_email}?subject=${encodeURIComponent(subject)}&body=${encodeURIComponent(body_text)}`;
+      window.location.href = mailto;
+    } catch (error) {
+      console.error("Error exporting email:", error);
+      toast.error("Fout bij exporteren naar e-mail");
+    }
+  };
+
+  // Open print-friendly receipt
+  const handlePrintReceipt = () => {
+    window.open(`${API}/orders/receipt`, "_blank");
   };
 
   // Save order email
@@ -654,7 +661,6 @@ function App() {
     try {
       const res = await axios.put(`${API}/settings`, { order_email: tempOrderEmail });
       setSettings(res.data);
-      logActivity("Instellingen gewijzigd", "Bestel e-mail bijgewerkt");
       toast.success("E-mailadres opgeslagen");
     } catch (error) {
       toast.error("Fout bij opslaan e-mailadres");
@@ -670,7 +676,6 @@ function App() {
         email_outro: tempEmailOutro
       });
       setSettings(res.data);
-      logActivity("Instellingen gewijzigd", "E-mail template bijgewerkt");
       toast.success("E-mail template opgeslagen");
       setIsEmailTemplateVisible(false);
     } catch (error) {
@@ -781,7 +786,7 @@ function App() {
                 ) : (
                   <div className="space-y-2">
                     <Button
-                      onClick={() => setIsLogVisible(true)}
+                      onClick={handleOpenLog}
                       variant="secondary"
                       size="sm"
                       className="w-full justify-start bg-[#2C2C2E] hover:bg-[#3A3A3C] text-white"
@@ -1126,16 +1131,28 @@ function App() {
                   Totaaloverzicht
                 </CardTitle>
                 {totalOverview.length > 0 && (
-                  <Button
-                    variant="secondary"
-                    size="sm"
-                    onClick={handleExportEmail}
-                    className="bg-[#2C2C2E] hover:bg-[#3A3A3C] text-white"
-                    data-testid="export-email-button"
-                  >
-                    <ExternalLink className="h-4 w-4 mr-2" />
-                    Exporteer naar e-mail
-                  </Button>
+                  <div className="flex gap-2">
+                    <Button
+                      variant="secondary"
+                      size="sm"
+                      onClick={handlePrintReceipt}
+                      className="bg-[#2C2C2E] hover:bg-[#3A3A3C] text-white"
+                      data-testid="print-receipt-button"
+                    >
+                      <Receipt className="h-4 w-4 mr-2" />
+                      Bon printen
+                    </Button>
+                    <Button
+                      variant="secondary"
+                      size="sm"
+                      onClick={handleExportEmail}
+                      className="bg-[#2C2C2E] hover:bg-[#3A3A3C] text-white"
+                      data-testid="export-email-button"
+                    >
+                      <ExternalLink className="h-4 w-4 mr-2" />
+                      Exporteer naar e-mail
+                    </Button>
+                  </div>
                 )}
               </CardHeader>
               <CardContent>